@@ -1,15 +1,25 @@
 import asyncio
+import io
 import time
 import random
 import os
 import re
+import tarfile
 
 import aiohttp
-import aiofiles
-from bs4 import BeautifulSoup
 
 from rate_limiter import RateLimiter
 
+SHARD_SIZE = 10000
+WRITE_BATCH_SIZE = 500
+LOG_QUEUE_SIZE = 10000
+LOG_BUFFER_SIZE = 65536
+LOG_FLUSH_EVERY = 100
+
+DEFENDANT_PAT = re.compile(r'defendant(\d+)\.html')
+DOCKET_PAT = re.compile(r'docket(\d+)\.html')
+CASE_LINK_PAT = re.compile(rb'href="([^"]*666666\.php[^"]*)"')
+
 
 class AsyncioOrleansScraper:
     """Custom scraper for Orleans Parish Website. Docket sheets are
@@ -40,154 +50,269 @@ class AsyncioOrleansScraper:
         self.failed_urls = []
         self.completed_defendants = []
         self.log_file = log_file
-        self.log_buffer = ''
-        self.log_len = 0
+        self.log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
         self.max_tokens = max_tokens
         self.rate = rate
         self.verbose = verbose
         self.links = set()
+        self.write_queue = None
+        self.link_queue = None
+        self.limiter = None
+        self.writer = None
+        self.downloaded = {}
 
     def log(self, message):
-        if self.verbose:
-            print(time.strftime('%c'))
-            print(message)
+        try:
+            self.log_queue.put_nowait((time.time(), message))
+        except asyncio.QueueFull:
+            pass
 
-        self.log_buffer += time.strftime('%c')
-        self.log_buffer += f"\n{message}\n"
+    @staticmethod
+    def format_log_entry(timestamp, message):
+        return f"{time.strftime('%c', time.localtime(timestamp))}\n{message}\n"
 
-        if self.log_len > 100000:
-            self.write_log()
+    async def write_log_entries(self):
+        with open(self.log_file, 'a', buffering=LOG_BUFFER_SIZE) as f:
+            pending = 0
+            while True:
+                entry = await self.log_queue.get()
+                if entry is None:
+                    break
+                line = self.format_log_entry(*entry)
+                if self.verbose:
+                    print(line, end='')
+                f.write(line)
+                pending += 1
+                if pending >= LOG_FLUSH_EVERY:
+                    f.flush()
+                    pending = 0
 
     def write_log(self):
         with open(self.log_file, 'a') as f:
-            f.write(self.log_buffer)
-            self.log_buffer = ''
-            self.log_len = 0
+            while True:
+                try:
+                    entry = self.log_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if entry is not None:
+                    f.write(self.format_log_entry(*entry))
 
     async def download_item(self, session, url_root, item):
         self.log(f"downloading {item}")
-        url = f"{url_root}{item}"
+        url = url_root + str(item)
         try:
-            async with await session.get(url) as response:
-                return await response.text(errors='ignore')
+            await self.limiter.acquire()
+            async with session.get(url) as response:
+                return await response.read()
         except (asyncio.TimeoutError, aiohttp.ClientError) as e:
             self.log(f"Timeout/ClientError downloading item {url}: {type(e)}")
             self.failed_urls.append(url)
             return
         except Exception as e:
-            self.failed_urls += url
+            self.failed_urls.append(url)
             self.log(f"Exception downloading item {url}: {type(e)}")
             raise e
 
     async def download_defendant(self, session, defendant):
-        def_data = await self.download_item(session,
-                                            self.def_url,
-                                            defendant)
-
-        if def_data:
-            return BeautifulSoup(def_data, 'html.parser')
-        else:
-            return None
+        return await self.download_item(session,
+                                        self.def_url,
+                                        defendant)
 
     async def download_sheet(self, session, link):
         return await self.download_item(session,
                                         self.sheet_url,
                                         link)
 
-    async def write_data(self, data, fname):
-        self.log(f"Writing {fname} of length: {len(str(data))}")
-        async with aiofiles.open(fname, 'wb') as f:
-            if data:
-                await f.write(str(data).encode('utf-8'))
+    @staticmethod
+    def shard_archive(path, prefix, item):
+        return f"{path}{prefix}-{item // SHARD_SIZE:04d}.tar"
 
     @staticmethod
-    def get_defendant_case_links(soup):
-        hrefs = [a['href'] for a in soup.find_all('a')]
-        return set(href for href in hrefs if '666666.php' in href)
+    def write_batch(batch):
+        archives = {}
+        for archive, fname, data in batch:
+            archives.setdefault(archive, []).append((fname, data))
+        for archive, pages in archives.items():
+            with tarfile.open(archive, 'a') as tar:
+                for fname, data in pages:
+                    info = tarfile.TarInfo(fname)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    tar.addfile(info, io.BytesIO(data))
+
+    async def write_pages(self):
+        done = False
+        while not done:
+            batch = [await self.write_queue.get()]
+            if batch[0] is None:
+                break
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self.write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            await asyncio.to_thread(self.write_batch, batch)
+        self.downloaded.clear()
+
+    async def write_data(self, data, fname, archive):
+        self.log(f"Writing {fname} ({len(data) if data else 0} bytes)")
+        if self.writer.done():
+            self.writer.result()
+        if data:
+            await self.write_queue.put((archive, fname, data))
+
+    @staticmethod
+    def get_defendant_case_links(html):
+        return {href.decode('ascii', 'ignore')
+                for href in CASE_LINK_PAT.findall(html)}
 
     async def download_defendant_data(self, session, defendant):
         try:
-            fname = f"{self.defendant_path}defendant{defendant}.html"
+            fname = f"defendant{defendant}.html"
+            archive = self.shard_archive(self.defendant_path,
+                                         'defendants',
+                                         defendant)
             defendant_data = await self.download_defendant(session, defendant)
             if defendant_data:
-                await self.write_data(defendant_data, fname)
+                await self.write_data(defendant_data, fname, archive)
                 links = self.get_defendant_case_links(defendant_data)
-                self.links = self.links.union(links)
+                new_links = links - self.links
+                self.links.update(new_links)
+                for link in new_links:
+                    if not link[-6:].isdigit():
+                        self.log(f"Skipping link without docket id: {link}")
+                        continue
+                    if not self.sheet_downloaded(link):
+                        await self.link_queue.put(link)
         except Exception as e:
             self.log(f"Exception with defendant {defendant}: {type(e)}")
             raise e
 
+    def sheet_downloaded(self, link):
+        return int(link[-6:]) in self.downloaded_ids(self.docket_path,
+                                                     DOCKET_PAT)
+
     async def download_sheet_data(self, session, link):
         try:
-            fname = f"{self.docket_path}docket{link[-6:]}.html"
+            fname = f"docket{link[-6:]}.html"
+            archive = self.shard_archive(self.docket_path,
+                                         'dockets',
+                                         int(link[-6:]))
             sheet_data = await self.download_sheet(session, link)
             if sheet_data:
-                await self.write_data(sheet_data, fname)
+                await self.write_data(sheet_data, fname, archive)
         except Exception as e:
             self.log(f"Exception with sheet {link}: {type(e)}")
             raise e
 
     @staticmethod
-    def check_missing(start, stop, path, fpattern):
-        downloaded = [int(i[:-5][-6:]) for i in os.listdir(path)
-                      if re.search(fpattern, i)]
-        return [j for j in range(start, stop) if j not in downloaded]
+    def list_downloaded(path):
+        names = []
+        for entry in os.scandir(path):
+            if entry.name.endswith('.tar'):
+                with tarfile.open(f"{path}{entry.name}") as tar:
+                    names.extend(tar.getnames())
+            else:
+                names.append(entry.name)
+        return names
+
+    def downloaded_ids(self, path, fpattern):
+        if path not in self.downloaded:
+            matches = (fpattern.match(i) for i in self.list_downloaded(path))
+            self.downloaded[path] = {int(m.group(1)) for m in matches if m}
+        return self.downloaded[path]
+
+    def check_missing(self, start, stop, path, fpattern):
+        downloaded = self.downloaded_ids(path, fpattern)
+        return list(set(range(start, stop)) - downloaded)
 
     def check_missing_defendants(self, start, stop):
         return self.check_missing(start,
                                   stop,
                                   self.defendant_path,
-                                  r'defendant\d+\.html')
+                                  DEFENDANT_PAT)
 
     def check_missing_sheets(self, start, stop):
         return self.check_missing(start,
                                   stop,
                                   self.docket_path,
-                                  r'docket\d+\.html')
+                                  DOCKET_PAT)
 
-    @staticmethod
-    def check_range_downloaded(start, stop, path, fpattern):
-        downloaded = [int(i[:-5][-6:]) for i in os.listdir(path)
-                      if re.search(fpattern, i)]
+    def check_range_downloaded(self, start, stop, path, fpattern):
+        downloaded = self.downloaded_ids(path, fpattern)
         return start in downloaded or stop in downloaded
 
     def check_defendant_range_downloaded(self, start, stop):
         return self.check_range_downloaded(start,
                                            stop,
                                            self.defendant_path,
-                                           r'defendant\d+\.html')
+                                           DEFENDANT_PAT)
 
     def check_sheet_range_downloaded(self, start, stop):
         return self.check_range_downloaded(start,
                                            stop,
                                            self.docket_path,
-                                           r'docket\d+\.html')
+                                           DOCKET_PAT)
+
+    async def work(self, queue, handler, session):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            await handler(session, item)
+
+    async def run_pool(self, handler, session, items):
+        queue = asyncio.Queue(maxsize=self.rate * 4)
+        async with asyncio.TaskGroup() as tg:
+            workers = [tg.create_task(self.work(queue, handler, session))
+                       for _ in range(self.max_tokens)]
+            for item in items:
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
 
     async def munch_defendants(self, defendants):
+        self.write_queue = asyncio.Queue()
+        self.link_queue = asyncio.Queue(maxsize=self.rate * 4)
+        self.limiter = RateLimiter(self.rate, self.max_tokens)
+        self.writer = asyncio.create_task(self.write_pages())
+        logger = asyncio.create_task(self.write_log_entries())
+        replenisher = asyncio.create_task(self.limiter.replenish())
         self.log(f"Munching started")
-        timeout = aiohttp.ClientTimeout(total=None)
-        async with aiohttp.ClientSession(
-                headers={"Connection": "close"},
-                timeout=timeout
-        ) as session:
-            session = RateLimiter(session, self.rate, self.max_tokens)
-            await asyncio.gather(
-                *[self.download_defendant_data(
-                    session,
-                    defendant
-                )
-                    for defendant in defendants]
-            )
-
-            await asyncio.gather(
-                *[self.download_sheet_data(
-                    session,
-                    link
-                )
-                    for link in self.links]
-            )
-            self.links = set()
-            self.log("Munching completed")
+        timeout = aiohttp.ClientTimeout(total=60)
+        connector = aiohttp.TCPConnector(limit=self.max_tokens * 2,
+                                         limit_per_host=self.max_tokens,
+                                         keepalive_timeout=30,
+                                         ttl_dns_cache=300)
+        try:
+            try:
+                async with aiohttp.ClientSession(
+                        connector=connector,
+                        timeout=timeout
+                ) as session:
+                    async with asyncio.TaskGroup() as tg:
+                        for _ in range(self.max_tokens):
+                            tg.create_task(self.work(self.link_queue,
+                                                     self.download_sheet_data,
+                                                     session))
+                        await self.run_pool(self.download_defendant_data,
+                                            session,
+                                            defendants)
+                        for _ in range(self.max_tokens):
+                            await self.link_queue.put(None)
+                    self.links = set()
+                    self.log("Munching completed")
+            finally:
+                replenisher.cancel()
+                await self.write_queue.put(None)
+                await self.writer
+        finally:
+            await self.log_queue.put(None)
+            await logger
 
     async def munch_missing(self, start, stop):
         defendants = self.check_missing_defendants(start, stop)
@@ -1,30 +1,26 @@
-import asyncio
-import time
-
-
-class RateLimiter:
-
-    def __init__(self, client, rate=10, max_tokens=10):
-        self.client = client
-        self.rate = rate
-        self.max_tokens = max_tokens
-        self.tokens = self.max_tokens
-        self.updated_at = time.monotonic()
-
-    async def get(self, *args, **kwargs):
-        await self.wait_for_token()
-        return self.client.get(*args, **kwargs)
-
-    async def wait_for_token(self):
-        while self.tokens <= 1:
-            self.add_new_tokens()
-            await asyncio.sleep(1)
-        self.tokens -= 1
-
-    def add_new_tokens(self):
-        now = time.monotonic()
-        time_since_update = now - self.updated_at
-        new_tokens = time_since_update * self.rate
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.max_tokens)
-            self.updated_at = now
+import asyncio
+
+
+class RateLimiter:
+    """Token bucket backed by a semaphore. Callers acquire() a token
+    before each request; one replenish() task restores spent tokens at
+    the configured rate, so pacing costs a single sleeping task instead
+    of a busy-wait check inside every request.
+    """
+
+    def __init__(self, rate=10, max_tokens=10):
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.tokens = asyncio.Semaphore(max_tokens)
+        self.spent = 0
+
+    async def acquire(self):
+        await self.tokens.acquire()
+        self.spent += 1
+
+    async def replenish(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            if self.spent > 0:
+                self.spent -= 1
+                self.tokens.release()